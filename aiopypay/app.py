@@ -1,12 +1,20 @@
 from aiohttp import web
 from .handlers import routes, auth_middleware
-from .db import init_pg, close_pg
+from .db import init_pg, migrate_pg, close_pg
+from .notifications import init_notifications, close_notifications
+from .limits import setup_limits, concurrency_middleware, rate_limit_middleware
 
 
 # noinspection PyUnusedLocal
-def get_app(argv):
-    app = web.Application(middlewares=[auth_middleware])
+def get_app(argv, force_recreate=False):
+    # Concurrency limit goes first to shed load before auth touches DB
+    app = web.Application(middlewares=[concurrency_middleware, auth_middleware, rate_limit_middleware])
+    app['force_recreate'] = force_recreate
+    setup_limits(app)
     app.on_startup.append(init_pg)
+    app.on_startup.append(migrate_pg)
+    app.on_startup.append(init_notifications)
     app.on_cleanup.append(close_pg)
+    app.on_cleanup.append(close_notifications)
     app.add_routes(routes)
     return app
@@ -1,6 +1,10 @@
+import asyncio
 import hashlib
+import logging
 import os
-from sqlalchemy import MetaData, create_engine, inspect
+
+import psycopg2
+from sqlalchemy import select, func
 import aiopg.sa
 from . import models
 
@@ -8,85 +12,216 @@ dsn = "postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRE
     **os.environ
 )
 
+# Max number of connections in app's pool, concurrency limits are derived from it
+POOL_SIZE = int(os.environ.get('APP_DB_POOL_SIZE', 10))
+
+# Arbitrary key of advisory lock, which serializes migrations between app instances
+MIGRATIONS_LOCK_ID = 0x61696f70
+
+# Migration fails instead of waiting longer for lock held by live traffic
+MIGRATIONS_LOCK_TIMEOUT = os.environ.get('APP_MIGRATIONS_LOCK_TIMEOUT', '5s')
 
-# ========== async
+
+# ========== app hooks
 
 async def init_pg(app):
-    engine = await aiopg.sa.create_engine(dsn)
+    engine = await aiopg.sa.create_engine(dsn, maxsize=POOL_SIZE)
     app['db'] = engine
 
 
+async def migrate_pg(app):
+    await migrate(app['db'], app['force_recreate'])
+
+
 async def close_pg(app):
     app['db'].close()
     await app['db'].wait_closed()
 
 
-# ========== regular
+# ========== migrations
+
+# Migrations are fixed snapshots of schema changes, they must not depend on current models
+# and must not be changed once released. Schema version is number of applied migrations,
+# so new ones are appended to the end of MIGRATIONS.
+
+async def initial(conn):
+    """ Tables as they were before versioning was introduced, with initial data. """
+    await conn.execute("""
+        CREATE TABLE currencies (
+            id VARCHAR(3) NOT NULL,
+            description VARCHAR NOT NULL,
+            comission FLOAT NOT NULL,
+            PRIMARY KEY (id)
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE users (
+            id SERIAL NOT NULL,
+            username VARCHAR NOT NULL,
+            password_hash VARCHAR NOT NULL,
+            full_name VARCHAR NOT NULL,
+            is_superuser BOOLEAN NOT NULL,
+            PRIMARY KEY (id)
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE accounts (
+            id SERIAL NOT NULL,
+            user_id INTEGER NOT NULL,
+            currency_id VARCHAR(3) NOT NULL,
+            amount FLOAT NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE RESTRICT,
+            FOREIGN KEY(currency_id) REFERENCES currencies (id) ON DELETE RESTRICT
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE transfers (
+            id SERIAL NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            from_account_id INTEGER NOT NULL,
+            to_account_id INTEGER NOT NULL,
+            amount FLOAT NOT NULL,
+            comment VARCHAR NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(from_account_id) REFERENCES accounts (id) ON DELETE CASCADE,
+            FOREIGN KEY(to_account_id) REFERENCES accounts (id) ON DELETE CASCADE
+        )
+    """)
+
+    # Create currencies
+    await conn.execute("""
+        INSERT INTO currencies (id, description, comission) VALUES
+            ('USD', 'United States Dollar', 0.01),
+            ('CNY', 'Chinese Yuan', 0.02),
+            ('EUR', 'Euro', 0.03)
+    """)
+
+    # Create superuser, and it's accounts, where comisions will be tansfered
+    superuser_id = await conn.scalar(
+        "INSERT INTO users (username, password_hash, full_name, is_superuser) "
+        "VALUES ('superuser', %s, 'Superuser', true) RETURNING id",
+        hashlib.md5(os.environ['APP_SUPERUSER_PASSWORD'].encode('utf-8')).hexdigest(),
+    )
+
+    await conn.execute("""
+        INSERT INTO accounts (user_id, currency_id, amount) VALUES
+            (%(id)s, 'USD', 0),
+            (%(id)s, 'CNY', 0),
+            (%(id)s, 'EUR', 0)
+    """, dict(id=superuser_id))
+
+
+def no_transaction(migration):
+    """ Marks migration which can not run in transaction, like CREATE INDEX CONCURRENTLY.
+    Such migration is applied in autocommit mode, so it should be safe to rerun if interrupted.
+    """
+    migration.transactional = False
+    return migration
 
-def get_engine():
-    return create_engine(dsn)
 
+async def create_index_concurrently(conn, name, table, column):
+    # Interrupted build leaves invalid index, which IF NOT EXISTS would take as done
+    if await conn.scalar('SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)', name):
+        await conn.execute('DROP INDEX CONCURRENTLY {}'.format(name))
+    await conn.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({})'.format(name, table, column))
 
-def create_tables(engine):
-    meta = MetaData()
-    meta.create_all(bind=engine, tables=[getattr(models, t) for t in models.__all__])
 
+@no_transaction
+async def create_indexes(conn):
+    """ Indexes for looking up accounts of user and transfers of account, built without blocking writes. """
+    await create_index_concurrently(conn, 'ix_accounts_user_id', 'accounts', 'user_id')
+    await create_index_concurrently(conn, 'ix_transfers_from_account_id', 'transfers', 'from_account_id')
+    await create_index_concurrently(conn, 'ix_transfers_to_account_id', 'transfers', 'to_account_id')
 
-def drop_tables(engine):
-    meta = MetaData()
-    meta.drop_all(bind=engine, tables=[getattr(models, t) for t in models.__all__])
 
+MIGRATIONS = [
+    initial,
+    create_indexes,
+]
 
-def init_data(engine):
-    with engine.connect() as conn:
-        # Create currencies
-        conn.execute(models.currencies.insert(), [
-            dict(id="USD", description="United States Dollar", comission=0.01),
-            dict(id="CNY", description="Chinese Yuan", comission=0.02),
-            dict(id="EUR", description="Euro", comission=0.03),
-        ])
 
-        # Create superuser, and it's accounts, where comisions will be tansfered
-        superuser_id = conn.execute(models.users.insert(values=dict(
-            username='superuser',
-            password_hash=hashlib.md5(os.environ['APP_SUPERUSER_PASSWORD'].encode('utf-8')).hexdigest(),
-            full_name='Superuser',
-            is_superuser=True,
-        ))).inserted_primary_key[0]
+async def get_version(conn):
+    """ Returns current schema version or None if database is not versioned yet. """
+    try:
+        return await conn.scalar('SELECT version FROM schema_version')
+    except psycopg2.errors.UndefinedTable:
+        return None
 
-        conn.execute(models.accounts.insert(), [
-            dict(user_id=superuser_id, currency_id="USD", amount=0),
-            dict(user_id=superuser_id, currency_id="CNY", amount=0),
-            dict(user_id=superuser_id, currency_id="EUR", amount=0),
-        ])
 
+async def drop_tables(engine):
+    async with engine.acquire() as conn:
+        async with conn.begin():
+            await _drop_tables(conn)
 
-def sample_data(engine):
-    pass
 
+async def _drop_tables(conn):
+    for t in ['schema_version'] + list(reversed(models.__all__)):
+        await conn.execute('DROP TABLE IF EXISTS {} CASCADE'.format(t))
 
-def is_empty(engine):
-    return not bool(inspect(engine).get_table_names())
 
+def is_current(version):
+    if version > len(MIGRATIONS):
+        logging.getLogger('aiohttp.server').error(
+            'Database schema version {} is newer than latest known {}, is app rolled back?'.format(
+                version, len(MIGRATIONS)
+            )
+        )
+    return version >= len(MIGRATIONS)
 
-def migrate(force_recreate):
-    """ Performs simple migration scenario.
-    Just creates tables for current models state, if database is empty.
-    In real production migration management tools should be used,
-    like alembic or migrate and migrations should be part of app deployment proccess.
-    """
 
-    engine = get_engine()
+async def migrate(engine, force_recreate=False):
+    """ Brings database schema to the latest version.
+    Migrations are applied one by one under advisory lock, so several app instances
+    can be started simultaneously. If schema is up to date it costs only one query.
+    """
 
-    if force_recreate or is_empty(engine):
+    async with engine.acquire() as conn:
+        version = await get_version(conn)
+        if not force_recreate and version is not None and is_current(version):
+            print("Working with initialized database.")
+            return
+
+        # Session level lock, as not every migration is run in transaction.
+        # Not waiting in pg_advisory_lock(), its statement would hold snapshot
+        # and CREATE INDEX CONCURRENTLY of other instance waits for older snapshots to finish.
+        while not await conn.scalar(select([func.pg_try_advisory_lock(MIGRATIONS_LOCK_ID)])):
+            await asyncio.sleep(0.5)
+        try:
+            await conn.execute('SET lock_timeout = %s', MIGRATIONS_LOCK_TIMEOUT)
+            await _migrate(conn, force_recreate)
+        finally:
+            # Connection goes back to the pool
+            await conn.execute('RESET lock_timeout')
+            await conn.execute(select([func.pg_advisory_unlock(MIGRATIONS_LOCK_ID)]))
+
+
+async def _migrate(conn, force_recreate):
+    async with conn.begin():
         if force_recreate:
             print("Dropping tables...")
-            drop_tables(engine)
-        print("Initializing database...")
-        create_tables(engine)
-        init_data(engine)
-        print('Done')
-    else:
-        print("Working with initialized database.")
+            await _drop_tables(conn)
+
+        await conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version integer NOT NULL)')
+        version = await conn.scalar('SELECT version FROM schema_version')
+        if version is None:
+            # Database initialized before versioning was introduced already has initial schema
+            version = 1 if await conn.scalar("SELECT to_regclass('currencies')") else 0
+            await conn.execute('INSERT INTO schema_version (version) VALUES (%s)', version)
 
-    engine.dispose()
+    if is_current(version):
+        # Other instance has done the job while we were waiting for lock
+        print("Working with initialized database.")
+        return
+
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        print("Applying migration {}...".format(migration.__name__))
+        if getattr(migration, 'transactional', True):
+            async with conn.begin():
+                await migration(conn)
+                await conn.execute('UPDATE schema_version SET version = %s', number)
+        else:
+            await migration(conn)
+            await conn.execute('UPDATE schema_version SET version = %s', number)
+
+    print('Done')
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import hashlib
 # noinspection PyUnresolvedReferences
@@ -8,9 +9,11 @@ import re
 from functools import wraps
 
 import psycopg2
-from aiohttp import web, BasicAuth
-from sqlalchemy import and_, select, or_, desc, asc
+from aiohttp import web, BasicAuth, WSCloseCode
+from sqlalchemy import and_, select, or_, desc, asc, func
 
+from .limits import route_class, retry_after
+from .notifications import CHANNEL, MAX_SUBSCRIBERS
 from .models import *
 
 
@@ -38,6 +41,18 @@ async def get_many(conn, clause):
     return list(map(dict, records))
 
 
+async def notify_transfers(conn, transfers_list):
+    """ Sends notification with made transfers and accounts updated by them.
+    Notification is delivered by DB only when transaction is committed.
+    """
+    account_ids = {t['from_account_id'] for t in transfers_list} | {t['to_account_id'] for t in transfers_list}
+    payload = json.dumps(dict(
+        accounts=await get_many(conn, accounts.select().where(accounts.c.id.in_(sorted(account_ids)))),
+        transfers=transfers_list,
+    ), default=str)
+    await conn.execute(select([func.pg_notify(CHANNEL, payload)]))
+
+
 # ===========================================
 # Basic Auth
 
@@ -198,6 +213,7 @@ async def create_account(request):
 # --------- Transfers
 
 @routes.post(r'/users/{user_id:\d+}/transfers')
+@route_class('transfer')
 @auth_required('user_id')
 async def make_transfer(request):
     form = await request.post()
@@ -232,6 +248,7 @@ async def make_transfer(request):
                 .insert()
                 .values(from_account_id=from_account_id, to_account_id=to_account_id,
                         amount=amount, comment=comment)
+                .returning(*transfers.c)
         )
 
     log('here')
@@ -288,9 +305,11 @@ async def make_transfer(request):
                     )
                 )
 
+            await notify_transfers(conn, result)
+
             log('here')
 
-    return web.json_response({"transfers": result})
+    return web.json_response({"transfers": result}, dumps=lambda o: json.dumps(o, default=str))
 
 
 @routes.get(r'/users/{user_id:\d+}/transfers')
@@ -342,3 +361,51 @@ async def get_transfers(request):
 
     return web.json_response(result, dumps=lambda o: json.dumps(o, default=str))
 
+
+# --------- Events
+
+@routes.get(r'/users/{user_id:\d+}/events')
+@auth_required('user_id')
+async def get_events(request):
+    user = request['authorized_user']
+    notifier = request.app['notifier']
+    if notifier.count >= MAX_SUBSCRIBERS:
+        raise web.HTTPServiceUnavailable(headers=retry_after(1))
+
+    ws = web.WebSocketResponse(heartbeat=30)
+    closing = False
+
+    async def send_events(subscription):
+        nonlocal closing
+        while True:
+            event = await subscription.get()
+            if event is None:
+                closing = True
+                await ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b'Too slow, events dropped')
+                return
+            await ws.send_json(event)
+
+    # Subscribe before handshake, so events are not lost right after connection
+    with notifier.subscribe(user['id']) as subscription:
+        await ws.prepare(request)
+
+        # Connection does not use DB anymore, so it should not occupy DB bound slot for its lifetime
+        request['concurrency_slot'].release()
+
+        sender = asyncio.ensure_future(send_events(subscription))
+        try:
+            # Nothing is expected from client, just wait until connection is closed
+            async for msg in ws:
+                pass
+        finally:
+            # Closing sender stops the loop above itself and has to finish sending close frame
+            if not closing:
+                sender.cancel()
+            try:
+                await sender
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                log('Sending events failed: {}'.format(e))
+
+    return ws
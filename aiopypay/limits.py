@@ -0,0 +1,199 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+
+from .db import POOL_SIZE
+
+# Per user token bucket: sustained requests per second and burst size.
+# Zero rate disables per user limiting.
+RATE_LIMIT = float(os.environ.get('APP_RATE_LIMIT', 20))
+RATE_BURST = int(os.environ.get('APP_RATE_BURST', 40))
+
+# Global concurrency limits per route class and how long request may wait for a slot.
+# Request holds at most one DB connection at a time, so slots of all classes together
+# are not more than pool size and admitted request never waits for connection.
+TRANSFER_CONCURRENCY = int(os.environ.get('APP_TRANSFER_CONCURRENCY', max(1, POOL_SIZE // 4)))
+if not 0 < TRANSFER_CONCURRENCY < POOL_SIZE:
+    raise ValueError('APP_TRANSFER_CONCURRENCY should be from 1 to APP_DB_POOL_SIZE - 1, got {} with pool of {}'.format(
+        TRANSFER_CONCURRENCY, POOL_SIZE
+    ))
+CONCURRENCY = {
+    'read': POOL_SIZE - TRANSFER_CONCURRENCY,
+    'transfer': TRANSFER_CONCURRENCY,
+}
+QUEUE_TIMEOUT = float(os.environ.get('APP_QUEUE_TIMEOUT', 0.5))
+
+
+# ===========================================
+# Limiters
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'timestamp')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+
+    def consume(self):
+        """ Takes one token.
+        Returns 0 on success or number of seconds until token will be available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """ Keeps token bucket for each key.
+    Least recently used buckets are evicted when there are more than max_keys of them,
+    evicted key just starts with full bucket again.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+
+    def consume(self, key):
+        if self.rate <= 0:
+            return 0
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+
+        return bucket.consume()
+
+
+class ConcurrencyLimiter:
+    """ Limits number of simultaneously processed requests.
+    Request waits for free slot not longer than timeout,
+    and is rejected at once if there are already as many waiting requests as slots.
+    """
+
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.waiting = 0
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self):
+        """ Returns True if slot is acquired, False if request should be shed. """
+        if not self.semaphore.locked():
+            await self.semaphore.acquire()
+            return True
+
+        if self.waiting >= self.limit:
+            return False
+
+        # Not wait_for(), it may lose the slot acquired just at timeout
+        self.waiting += 1
+        acquire = asyncio.ensure_future(self.semaphore.acquire())
+        try:
+            await asyncio.wait([acquire], timeout=self.timeout)
+        except asyncio.CancelledError:
+            if acquire.done():
+                self.semaphore.release()
+            else:
+                acquire.cancel()
+            raise
+        finally:
+            self.waiting -= 1
+
+        if acquire.done():
+            return True
+
+        acquire.cancel()
+        return False
+
+    def release(self):
+        self.semaphore.release()
+
+
+class Slot:
+    """ Slot acquired by request, may be released by handler before request is finished. """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.limiter.release()
+
+
+# ===========================================
+# App setup
+
+def setup_limits(app):
+    app['rate_limiter'] = RateLimiter(RATE_LIMIT, RATE_BURST)
+    app.on_startup.append(init_limits)
+
+
+async def init_limits(app):
+    # Semaphores should be created within running loop
+    app['concurrency_limiters'] = {
+        name: ConcurrencyLimiter(limit, QUEUE_TIMEOUT) for name, limit in CONCURRENCY.items()
+    }
+
+
+def route_class(name):
+    """ Marks handler as belonging to route class with separate concurrency limit.
+    Handlers without mark are treated as 'read'.
+    """
+
+    def wrapper(handler):
+        handler.route_class = name
+        return handler
+
+    return wrapper
+
+
+def retry_after(seconds):
+    return {'Retry-After': str(max(1, math.ceil(seconds)))}
+
+
+# ===========================================
+# Middlewares
+
+@web.middleware
+async def concurrency_middleware(request, handler):
+    name = getattr(request.match_info.handler, 'route_class', 'read')
+    limiter = request.app['concurrency_limiters'][name]
+
+    if not await limiter.acquire():
+        raise web.HTTPServiceUnavailable(headers=retry_after(limiter.timeout))
+
+    request['concurrency_slot'] = slot = Slot(limiter)
+    try:
+        return await handler(request)
+    finally:
+        slot.release()
+
+
+@web.middleware
+async def rate_limit_middleware(request, handler):
+    if 'authorized_user' in request:
+        wait = request.app['rate_limiter'].consume(request['authorized_user']['id'])
+        if wait:
+            raise web.HTTPTooManyRequests(headers=retry_after(wait))
+
+    return await handler(request)
@@ -1,6 +1,7 @@
 from datetime import datetime
 from sqlalchemy import MetaData, Table, Column, ForeignKey, Integer, String, DateTime, Float, Boolean
 
+# Tables are not created from models, schema is managed by migrations in db.py
 meta = MetaData()
 
 __all__ = ['currencies', 'users', 'accounts', 'transfers']
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+
+import aiopg
+
+from .db import dsn
+
+CHANNEL = 'transfers'
+
+# Max number of undelivered events per client, slow client is disconnected when exceeded
+BUFFER_SIZE = int(os.environ.get('APP_EVENTS_BUFFER', 100))
+
+# Max number of connected clients per app instance
+MAX_SUBSCRIBERS = int(os.environ.get('APP_EVENTS_MAX_SUBSCRIBERS', 1000))
+
+# Listening connection is checked if there were no notifications for that long
+KEEPALIVE = 30
+
+logger = logging.getLogger('aiohttp.server')
+
+
+# ===========================================
+
+class Subscription:
+    def __init__(self, maxsize):
+        self.queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, event):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Drop buffered events and let consumer know it's lagged behind
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    async def get(self):
+        """ Returns next event or None if subscription is overflowed. """
+        return await self.queue.get()
+
+
+class Notifier:
+    """ Listens transfer notifications from DB on single connection and fans them out to subscribed users. """
+
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self.subscriptions = defaultdict(set)
+        self.count = 0
+        self.conn = None
+        self.task = None
+
+    @contextmanager
+    def subscribe(self, user_id):
+        subscription = Subscription(self.buffer_size)
+        self.subscriptions[user_id].add(subscription)
+        self.count += 1
+        try:
+            yield subscription
+        finally:
+            self.count -= 1
+            self.subscriptions[user_id].discard(subscription)
+            if not self.subscriptions[user_id]:
+                del self.subscriptions[user_id]
+
+    def publish(self, event):
+        """ Sends to each user only their own accounts and transfers touching them. """
+        for user_id in {a['user_id'] for a in event['accounts']}:
+            if user_id not in self.subscriptions:
+                continue
+
+            user_accounts = [a for a in event['accounts'] if a['user_id'] == user_id]
+            account_ids = {a['id'] for a in user_accounts}
+            user_event = dict(
+                accounts=user_accounts,
+                transfers=[
+                    t for t in event['transfers']
+                    if t['from_account_id'] in account_ids or t['to_account_id'] in account_ids
+                ],
+            )
+
+            for subscription in self.subscriptions[user_id]:
+                subscription.put(user_event)
+
+    async def connect(self):
+        self.conn = await aiopg.connect(dsn)
+        async with self.conn.cursor() as cur:
+            await cur.execute('LISTEN {}'.format(CHANNEL))
+
+    async def receive(self):
+        while True:
+            try:
+                msg = await asyncio.wait_for(self.conn.notifies.get(), KEEPALIVE)
+            except asyncio.TimeoutError:
+                # Broken connection does not wake up notifies queue, so check it explicitly
+                async with self.conn.cursor() as cur:
+                    await cur.execute('SELECT 1')
+                continue
+            self.publish(json.loads(msg.payload))
+
+    async def run(self):
+        while True:
+            try:
+                await self.receive()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Notifications connection failed, reconnecting')
+
+            await self.close_connection()
+            while True:
+                await asyncio.sleep(1)
+                try:
+                    await self.connect()
+                    break
+                except Exception as e:
+                    logger.debug('Reconnect failed: {}'.format(e))
+                    await self.close_connection()
+
+    async def close_connection(self):
+        if self.conn is not None and not self.conn.closed:
+            await self.conn.close()
+        self.conn = None
+
+
+# ===========================================
+
+async def init_notifications(app):
+    notifier = Notifier(BUFFER_SIZE)
+    await notifier.connect()
+    notifier.task = asyncio.ensure_future(notifier.run())
+    app['notifier'] = notifier
+
+
+async def close_notifications(app):
+    notifier = app['notifier']
+    notifier.task.cancel()
+    try:
+        await notifier.task
+    except asyncio.CancelledError:
+        pass
+    await notifier.close_connection()
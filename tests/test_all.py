@@ -1,10 +1,14 @@
+import asyncio
 import os
 
+import aiopg.sa
 import pytest
-from aiohttp import BasicAuth
+from aiohttp import BasicAuth, WSCloseCode, WSMsgType
 
 from aiopypay.app import get_app
-from aiopypay.db import migrate, drop_tables, get_engine
+from aiopypay.db import dsn, migrate, drop_tables, get_version, initial, MIGRATIONS
+from aiopypay.limits import RateLimiter, ConcurrencyLimiter
+from aiopypay.notifications import Notifier
 
 
 # ===========================================
@@ -16,10 +20,25 @@ async def cli(aiohttp_client, tables):
 
 
 @pytest.fixture
-async def tables():
-    migrate(True)
+async def engine(loop):
+    engine = await aiopg.sa.create_engine(dsn)
+    yield engine
+    engine.close()
+    await engine.wait_closed()
+
+
+@pytest.fixture
+async def empty_db(engine):
+    await drop_tables(engine)
+    yield
+    await drop_tables(engine)
+
+
+@pytest.fixture
+async def tables(engine):
+    await migrate(engine, force_recreate=True)
     yield
-    drop_tables(get_engine())
+    await drop_tables(engine)
 
 
 async def create_vasya(cli):
@@ -45,6 +64,64 @@ async def test_currencies(cli):
     assert len(clist) == 3
 
 
+async def test_migrate_twice(engine, tables):
+    await migrate(engine)
+    async with engine.acquire() as conn:
+        assert await get_version(conn) == len(MIGRATIONS)
+        assert await conn.scalar('SELECT count(*) FROM currencies') == 3
+
+
+async def test_migrate_concurrently(engine, empty_db):
+    await asyncio.gather(migrate(engine), migrate(engine), migrate(engine))
+    async with engine.acquire() as conn:
+        assert await get_version(conn) == len(MIGRATIONS)
+        assert await conn.scalar('SELECT count(*) FROM currencies') == 3
+        assert await conn.scalar('SELECT count(*) FROM users') == 1
+
+
+async def test_migrate_unversioned(engine, empty_db):
+    # Database created before versioning was introduced
+    async with engine.acquire() as conn:
+        async with conn.begin():
+            await initial(conn)
+        assert await get_version(conn) is None
+
+    await migrate(engine)
+
+    async with engine.acquire() as conn:
+        assert await get_version(conn) == len(MIGRATIONS)
+        assert await conn.scalar('SELECT count(*) FROM currencies') == 3
+        assert await conn.scalar(
+            "SELECT count(*) FROM pg_indexes WHERE indexname IN "
+            "('ix_accounts_user_id', 'ix_transfers_from_account_id', 'ix_transfers_to_account_id')"
+        ) == 3
+
+
+async def test_migrate_rerun_interrupted(engine, tables):
+    # Index migration was applied, but instance died before version was updated
+    async with engine.acquire() as conn:
+        await conn.execute('UPDATE schema_version SET version = 1')
+        await conn.execute('DROP INDEX ix_transfers_to_account_id')
+
+    await migrate(engine)
+
+    async with engine.acquire() as conn:
+        assert await get_version(conn) == len(MIGRATIONS)
+        assert await conn.scalar(
+            "SELECT count(*) FROM pg_indexes WHERE indexname LIKE 'ix_%%'"
+        ) == 3
+
+
+async def test_migrate_newer_database(engine, tables):
+    async with engine.acquire() as conn:
+        await conn.execute('UPDATE schema_version SET version = %s', len(MIGRATIONS) + 1)
+
+    await migrate(engine)
+
+    async with engine.acquire() as conn:
+        assert await get_version(conn) == len(MIGRATIONS) + 1
+
+
 async def test_bad_uri(cli):
     response = await cli.get('/currencies/111')
     assert response.status == 404
@@ -154,6 +231,7 @@ async def test_transfer_with_comission(cli):
     assert response.status == 200
     transfers = (await response.json())['transfers']
     assert len(transfers) == 2
+    assert set(transfers[0]) == {'id', 'timestamp', 'from_account_id', 'to_account_id', 'amount', 'comment'}
 
     response = await cli.get('/users/2/transfers', auth=BasicAuth('vasya', 'pass'))
     assert response.status == 200
@@ -205,3 +283,154 @@ async def test_transfer_without_comission(cli):
     response = await cli.get('/accounts/7', auth=BasicAuth('vasya', 'pass'))
     account = await response.json()
     assert account['amount'] == 10
+
+
+async def test_transfer_events(cli):
+    await create_vasya(cli)
+    await create_frosya(cli)
+
+    ws = await cli.ws_connect('/users/3/events', auth=BasicAuth('frosya', 'pass'))
+    superuser_ws = await cli.ws_connect(
+        '/users/1/events', auth=BasicAuth('superuser', os.environ['APP_SUPERUSER_PASSWORD'])
+    )
+
+    response = await cli.post(
+        '/users/2/transfers',
+        auth=BasicAuth('vasya', 'pass'),
+        data={'from': 4, 'to': 7, 'amount': 10}
+    )
+    assert response.status == 200
+
+    event = await ws.receive_json(timeout=5)
+    assert [a['id'] for a in event['accounts']] == [7]
+    assert event['accounts'][0]['amount'] == 110
+    assert len(event['transfers']) == 1
+    assert event['transfers'][0]['comment'] == 'External payment'
+
+    # Superuser is notified about commission only
+    event = await superuser_ws.receive_json(timeout=5)
+    assert [a['user_id'] for a in event['accounts']] == [1]
+    assert len(event['transfers']) == 1
+    assert event['transfers'][0]['comment'] == 'Commission'
+
+    await ws.close()
+    await superuser_ws.close()
+
+    response = await cli.get('/users/2/events', auth=BasicAuth('frosya', 'pass'))
+    assert response.status == 403
+
+
+async def test_slow_events_client(cli):
+    await create_frosya(cli)
+
+    ws = await cli.ws_connect('/users/2/events', auth=BasicAuth('frosya', 'pass'))
+
+    notifier = cli.server.app['notifier']
+    subscription, = notifier.subscriptions[2]
+    for i in range(notifier.buffer_size + 1):
+        subscription.put({'accounts': [], 'transfers': []})
+
+    msg = await ws.receive(timeout=5)
+    assert msg.type == WSMsgType.CLOSE
+    assert msg.data == WSCloseCode.TRY_AGAIN_LATER
+    await ws.close()
+
+
+async def test_notifier_publish(cli):
+    await create_vasya(cli)
+    await create_frosya(cli)
+
+    response = await cli.post(
+        '/users/2/transfers',
+        auth=BasicAuth('vasya', 'pass'),
+        data={'from': 4, 'to': 7, 'amount': 10}
+    )
+    assert response.status == 200
+    external, commission = (await response.json())['transfers']
+
+    accounts = [
+        await (await cli.get('/accounts/1', auth=BasicAuth('superuser', os.environ['APP_SUPERUSER_PASSWORD']))).json(),
+        await (await cli.get('/accounts/4', auth=BasicAuth('vasya', 'pass'))).json(),
+        await (await cli.get('/accounts/7', auth=BasicAuth('frosya', 'pass'))).json(),
+    ]
+
+    notifier = Notifier(buffer_size=10)
+    with notifier.subscribe(2) as vasya, notifier.subscribe(3) as frosya, notifier.subscribe(5) as other:
+        notifier.publish({'accounts': accounts, 'transfers': [external, commission]})
+
+        assert vasya.queue.get_nowait() == {'accounts': accounts[1:2], 'transfers': [external, commission]}
+        assert frosya.queue.get_nowait() == {'accounts': accounts[2:], 'transfers': [external]}
+        assert other.queue.empty()
+
+    assert notifier.count == 0
+    assert not notifier.subscriptions
+
+
+# -------------------------------------------
+
+async def test_rate_limit(aiohttp_client, tables):
+    app = get_app([])
+    app['rate_limiter'] = RateLimiter(rate=0.1, burst=2)
+    cli = await aiohttp_client(app)
+
+    await create_vasya(cli)
+    for _ in range(2):
+        response = await cli.get('/users/2/accounts', auth=BasicAuth('vasya', 'pass'))
+        assert response.status == 200
+
+    response = await cli.get('/users/2/accounts', auth=BasicAuth('vasya', 'pass'))
+    assert response.status == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+    # Other users are not affected
+    await create_frosya(cli)
+    response = await cli.get('/users/3/accounts', auth=BasicAuth('frosya', 'pass'))
+    assert response.status == 200
+
+
+async def test_concurrency_limiter():
+    limiter = ConcurrencyLimiter(limit=1, timeout=0.1)
+
+    # Free slot is taken at once, busy one is waited for until timeout
+    assert await limiter.acquire()
+    assert not await limiter.acquire()
+    assert limiter.waiting == 0
+
+    # Waiting requests are limited, the one above it is rejected without waiting
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    assert limiter.waiting == 1
+    assert not await limiter.acquire()
+    limiter.release()
+    assert await waiter
+
+    # Cancelled waiter does not take slot
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert limiter.waiting == 0
+    assert limiter.semaphore.locked()
+
+    # Waiter cancelled right when slot is acquired gives it back
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    limiter.release()
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert not limiter.semaphore.locked()
+
+
+async def test_concurrency_limit(cli):
+    limiter = cli.server.app['concurrency_limiters']['read'] = ConcurrencyLimiter(limit=1, timeout=0.1)
+
+    assert await limiter.acquire()
+    response = await cli.get('/currencies')
+    assert response.status == 503
+    assert response.headers['Retry-After'] == '1'
+
+    limiter.release()
+    response = await cli.get('/currencies')
+    assert response.status == 200